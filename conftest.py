@@ -34,3 +34,15 @@ collect_ignore = [
 if sys.version_info < (2, 7):
     collect_ignore.append("gc3libs/backends/openstack.py")
     collect_ignore.append("gc3libs/backends/tests/test_openstack.py")
+
+
+def pytest_cmdline_preparse(config, args):
+    """
+    Distribute tests over all CPUs when plugin `pytest-xdist` is available,
+    unless the number of worker processes is given on the command line.
+    """
+    if not config.pluginmanager.hasplugin('xdist'):
+        return
+    if any(arg.startswith(('-n', '--numprocesses')) for arg in args):
+        return
+    args[:0] = ['-n', 'auto']
@@ -44,27 +44,89 @@ if __name__ == "__main__":
     import getl
     getl.getlScript().run()
 
+import bz2
+import gzip
 import os
-import tarfile
-import zipfile
+import re
+import zlib
+from contextlib import closing
 
 from pkg_resources import Requirement, resource_filename
 
 from gc3libs import Application
 from gc3libs.cmdline import SessionBasedScript, existing_file, existing_directory
 
-COMMAND = "python archive-etl.py {archive_file} {cores}"
+COMMAND = "python archive-etl.py -a {archive_file} -p {cores}"
+
+# path of the default `archive-etl.py` script, see `_get_wrapper_path`
+_WRAPPER_PATH = None
+
+
+# placeholders in the output directory name, all replaced by the job name
+_OUTPUT_DIR_TOKENS = re.compile(r'NAME|SESSION|DATE|TIME')
 
 
 ## Utility methods
+
+# magic numbers recognized by `_is_archive`
+_ZIP_MAGIC = b'PK\x03\x04'
+_TAR_MAGIC = b'ustar'
+_TAR_MAGIC_OFFSET = 257
+# gzip and bzip2, possibly compressed tar files
+_GZIP_MAGIC = b'\x1f\x8b'
+_BZ2_MAGIC = b'BZh'
+
+
+def _is_archive(path):
+    """
+    Return ``True`` if file `path` starts with the magic number
+    of a zip, tar or compressed tar file.
+    """
+    size = _TAR_MAGIC_OFFSET + len(_TAR_MAGIC)
+    try:
+        with open(path, 'rb') as fp:
+            header = fp.read(size)
+    except IOError:
+        # e.g., a directory
+        return False
+    if header.startswith(_ZIP_MAGIC):
+        return True
+    # a compressed file is a tar archive only if the data it holds is
+    # (e.g., ``data.csv.gz`` is not, though it has the gzip magic number)
+    if header.startswith(_GZIP_MAGIC):
+        opener = gzip.open
+    elif header.startswith(_BZ2_MAGIC):
+        opener = bz2.BZ2File
+    else:
+        opener = None
+    if opener is not None:
+        try:
+            with closing(opener(path)) as fp:
+                header = fp.read(size)
+        except (IOError, EOFError, zlib.error):
+            return False
+    return header[_TAR_MAGIC_OFFSET:] == _TAR_MAGIC
+
+
+def _get_wrapper_path():
+    """
+    Return path to the `archive-etl.py` script shipped with GC3Pie.
+
+    The `pkg_resources` lookup is done only once, on first call.
+    """
+    global _WRAPPER_PATH
+    if _WRAPPER_PATH is None:
+        _WRAPPER_PATH = resource_filename(Requirement.parse("gc3pie"),
+                                          "gc3libs/etc/archive-etl.py")
+    return _WRAPPER_PATH
+
+
 def _get_archives(input_folder):
     """
     Returns list of valid .tar/.zip input files.
     """
-    return [os.path.join(input_folder, valid_input_files)
-            for valid_input_files in os.listdir(input_folder)
-            if tarfile.is_tarfile(os.path.join(input_folder, valid_input_files))
-            or zipfile.is_zipfile(os.path.join(input_folder, valid_input_files))]
+    paths = (os.path.join(input_folder, name) for name in os.listdir(input_folder))
+    return [path for path in paths if _is_archive(path)]
 
 
 ## custom application class
@@ -82,16 +144,14 @@ class getlApplication(Application):
 
         if not extra_args['sharedFS']:
             inputs[input_file] = os.path.basename(input_file)
-            cmd = COMMAND.format(twitter_file=inputs[input_file], cores=cores)
+            cmd = COMMAND.format(archive_file=inputs[input_file], cores=cores)
         else:
-            cmd = COMMAND.format(twitter_file=input_file, cores=cores)
+            cmd = COMMAND.format(archive_file=input_file, cores=cores)
             
         if getl_script:
             inputs[getl_script] = "./archive-etl.py"
         else:
-            wrapper = resource_filename(Requirement.parse("gc3pie"),
-                                        "gc3libs/etc/archive-etl.py")
-            inputs[wrapper] = "./archive-etl.py"
+            inputs[_get_wrapper_path()] = "./archive-etl.py"
 
         extra_args['requested_cores'] = cores
 
@@ -162,11 +222,7 @@ class getlScript(SessionBasedScript):
                 
             extra_args = extra.copy()
             extra_args['jobname'] = job_name
-            extra_args['output_dir'] = self.params.output
-            extra_args['output_dir'] = extra_args['output_dir'].replace('NAME', job_name)
-            extra_args['output_dir'] = extra_args['output_dir'].replace('SESSION', job_name)
-            extra_args['output_dir'] = extra_args['output_dir'].replace('DATE', job_name)
-            extra_args['output_dir'] = extra_args['output_dir'].replace('TIME', job_name)
+            extra_args['output_dir'] = _OUTPUT_DIR_TOKENS.sub(lambda _: job_name, self.params.output)
             extra_args['sharedFS'] = self.params.shared_FS
 
             self.log.debug("Creating Application for twitter data '%s'" % input_file)
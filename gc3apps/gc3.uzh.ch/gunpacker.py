@@ -43,9 +43,12 @@ if __name__ == "__main__":
     import gunpacker
     gunpacker.gunpackerScript().run()
 
+import bz2
+import gzip
 import os
-import tarfile
-import zipfile
+import re
+import zlib
+from contextlib import closing
 
 from pkg_resources import Requirement, resource_filename
 
@@ -53,15 +56,58 @@ from gc3libs import Application
 from gc3libs.cmdline import SessionBasedScript, existing_file, existing_directory
 
 
+# placeholders in the output directory name, all replaced by the job name
+_OUTPUT_DIR_TOKENS = re.compile(r'NAME|SESSION|DATE|TIME')
+
+
 ## Utility methods
+
+# magic numbers recognized by `_is_archive`
+_ZIP_MAGIC = b'PK\x03\x04'
+_TAR_MAGIC = b'ustar'
+_TAR_MAGIC_OFFSET = 257
+# gzip and bzip2, possibly compressed tar files
+_GZIP_MAGIC = b'\x1f\x8b'
+_BZ2_MAGIC = b'BZh'
+
+
+def _is_archive(path):
+    """
+    Return ``True`` if file `path` starts with the magic number
+    of a zip, tar or compressed tar file.
+    """
+    size = _TAR_MAGIC_OFFSET + len(_TAR_MAGIC)
+    try:
+        with open(path, 'rb') as fp:
+            header = fp.read(size)
+    except IOError:
+        # e.g., a directory
+        return False
+    if header.startswith(_ZIP_MAGIC):
+        return True
+    # a compressed file is a tar archive only if the data it holds is
+    # (e.g., ``data.csv.gz`` is not, though it has the gzip magic number)
+    if header.startswith(_GZIP_MAGIC):
+        opener = gzip.open
+    elif header.startswith(_BZ2_MAGIC):
+        opener = bz2.BZ2File
+    else:
+        opener = None
+    if opener is not None:
+        try:
+            with closing(opener(path)) as fp:
+                header = fp.read(size)
+        except (IOError, EOFError, zlib.error):
+            return False
+    return header[_TAR_MAGIC_OFFSET:] == _TAR_MAGIC
+
+
 def _get_archives(input_folder):
     """
     Returns list of valid .tar/.zip input files.
     """
-    return [os.path.join(input_folder, valid_input_files)
-            for valid_input_files in os.listdir(input_folder)
-            if tarfile.is_tarfile(os.path.join(input_folder, valid_input_files))
-            or zipfile.is_zipfile(os.path.join(input_folder, valid_input_files))]
+    paths = (os.path.join(input_folder, name) for name in os.listdir(input_folder))
+    return [path for path in paths if _is_archive(path)]
 
 
 ## custom application class
@@ -170,11 +216,7 @@ class gunpackerScript(SessionBasedScript):
                 
             extra_args = extra.copy()
             extra_args['jobname'] = job_name
-            extra_args['output_dir'] = self.params.output
-            extra_args['output_dir'] = extra_args['output_dir'].replace('NAME', job_name)
-            extra_args['output_dir'] = extra_args['output_dir'].replace('SESSION', job_name)
-            extra_args['output_dir'] = extra_args['output_dir'].replace('DATE', job_name)
-            extra_args['output_dir'] = extra_args['output_dir'].replace('TIME', job_name)
+            extra_args['output_dir'] = _OUTPUT_DIR_TOKENS.sub(lambda _: job_name, self.params.output)
             extra_args['gunpacker_script'] = self.params.gunpacker_script
             extra_args['sharedFS'] = self.params.shared_FS
             extra_args['requested_cores'] = self.params.core_count
@@ -1,188 +1,890 @@
 import argparse
 import bz2
 import csv
+import io
 import json
+import multiprocessing
 import os
+import shutil
 import tarfile
+import tempfile
 import time
-from multiprocessing import Manager, Process, current_process, cpu_count
+import zlib
+from contextlib import closing
+from io import BytesIO
+from itertools import chain, islice
+from multiprocessing import Process, Queue, current_process, cpu_count
 from zipfile import ZipFile, is_zipfile
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # no read-ahead of archive files
+    ThreadPoolExecutor = None
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, data goes to the writer through a plain queue
+    shared_memory = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    # fall back to bz2 compression of the output file
+    zstd = None
+
+# optional C-level parsers for the hot decoding loop
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pa_csv = pq = None
+
+# optional parallel decompressors; the (single-threaded)
+# `bz2` and `zlib` modules are used when not available
+try:
+    import indexed_bzip2
+except ImportError:
+    indexed_bzip2 = None
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+# size of the blocks read from archive members
+CHUNK_SIZE = 1 << 20
+# buffer size of the uncompressed output file
+WRITE_BUFFER_SIZE = 1 << 20
+# maximum number of archive files (and bytes of file data) sent to a worker at once
+FILE_BATCH_SIZE = 256
+FILE_BATCH_BYTES = 16 << 20
+# maximum size of a zip archive file to read ahead, larger ones are streamed
+PREFETCH_BYTES = 64 << 20
+# maximum size of a compressed tar archive file sent to the workers along
+# with its data; the workers extract larger ones from the archive themselves
+TAR_INLINE_BYTES = 16 << 20
+# number of output rows sent to the writer in one queue message
+WRITE_BATCH_SIZE = 1000
+# shared memory used to hand data over to the writer: number and size of slots
+SHM_SLOTS = 64
+SHM_SLOT_SIZE = 1 << 20
+# number of CSV lines parsed at once by `pyarrow`
+CSV_BATCH_LINES = 10000
+# number of leading lines used to detect the data type
+SAMPLE_LINES = 10
+BZ2_MAGIC = b'BZh'
+GZIP_MAGIC = b'\x1f\x8b'
+
+if str is bytes:
+    # Python 2: the `csv` and `json` modules parse byte strings
+    def _to_text(line):
+        return line
+
+    def _to_bytes(value):
+        # `pyarrow` returns unicode strings
+        return value.encode('utf-8') if isinstance(value, unicode) else value
+else:
+    # Python 3: lines are read as bytes, but parsed as text; undecodable
+    # bytes are carried along as surrogates and written back unchanged
+    def _to_text(line):
+        return line.decode('utf-8', 'surrogateescape')
+
+    def _to_bytes(value):
+        return value.encode('utf-8', 'surrogateescape')
+
+
+def _iter_json_records(obj):
+    # JSON data holds either a list of records, or a single record
+    if isinstance(obj, list):
+        return iter(obj)
+    return iter((obj,))
+
+
+def _starts_json_document(line):
+    return line.lstrip().startswith(('[', '{'))
+
+
+def _load_json_document(lines):
+    """
+    Parse `lines` as a single JSON document (e.g., pretty-printed over
+    several lines); return None if they do not hold a valid one.
+    """
+    try:
+        return json_loads('\n'.join(lines))
+    except ValueError:
+        return None
+
 
 class Decoder(object):
 
-    def __init__(self):
-        self._dialect = None
-        self._data_type = None
+    def __init__(self, data_type=None, dialect=None):
+        """
+        :param data_type: type of the data (csv, json, text), detected from the data if None
+        :param dialect: CSV dialect, sniffed from the data if None
+        """
+        self._dialect = dialect
+        self._data_type = data_type
 
-    def _decode_csv_(self, data):
-        for line in csv.reader(data.splitlines(), delimiter=self._dialect.delimiter, quotechar=self._dialect.quotechar):
-            yield line
+    def _decode_csv_(self, lines):
+        if pa_csv is None:
+            for line in csv.reader(lines, delimiter=self._dialect.delimiter, quotechar=self._dialect.quotechar):
+                yield line
+            return
+        for batch in iter_batches(lines, CSV_BATCH_LINES):
+            try:
+                rows = self._parse_csv_batch_(batch)
+            except ValueError:
+                # `pyarrow` is stricter than `csv` (e.g., on ragged rows)
+                rows = csv.reader(batch, delimiter=self._dialect.delimiter, quotechar=self._dialect.quotechar)
+            for row in rows:
+                yield row
+
+    def _parse_csv_batch_(self, batch):
+        """
+        Parse a list of CSV lines with the `pyarrow` C parser, keeping
+        all values as strings.
+        """
+        data = _to_bytes('\n'.join(batch))
+        columns = len(next(csv.reader(batch[:1], delimiter=self._dialect.delimiter,
+                                      quotechar=self._dialect.quotechar)))
+        names = ['f{0}'.format(n) for n in range(columns)]
+        table = pa_csv.read_csv(
+            BytesIO(data),
+            read_options=pa_csv.ReadOptions(column_names=names),
+            parse_options=pa_csv.ParseOptions(delimiter=self._dialect.delimiter,
+                                              quote_char=(self._dialect.quotechar or False)),
+            convert_options=pa_csv.ConvertOptions(column_types=dict.fromkeys(names, pa.string())))
+        return zip(*[column.to_pylist() for column in table.columns])
 
-    def _decode_json_(self, data):
+    def _decode_json_(self, lines):
+        lines = iter(lines)
+        first = next(lines, None)
+        if first is None:
+            return
         try:
-            for o in json.loads(data):
-                yield o
+            records = _iter_json_records(json_loads(first))
         except ValueError:
-            pass
-        for line in data.splitlines():
+            records = ()
+            if _starts_json_document(first):
+                # maybe not one JSON value per line, but a single document;
+                # keep the lines, to parse them one by one if it is not
+                lines = list(lines)
+                obj = _load_json_document([first] + lines)
+                if obj is not None:
+                    for o in _iter_json_records(obj):
+                        yield o
+                    return
+        for o in records:
+            yield o
+        for line in lines:
             try:
-                for o in json.loads(line):
-                    yield o
+                obj = json_loads(line)
             except ValueError:
-                pass
+                continue
+            for o in _iter_json_records(obj):
+                yield o
 
-    def _detect_data_type_(self, data):
+    def _sniff_dialect_(self, lines):
+        return csv.Sniffer().sniff('\n'.join(line for line in lines if not line.startswith('#')))
+
+    def _detect_data_type_(self, lines):
+        if not lines:
+            return 'text'
         try:
-            json.loads(data)
+            json.loads(lines[0])
             return 'json'
         except ValueError:
-            try:
-                json.loads(data.split('\n')[0])
-                return 'json'
-            except ValueError:
-                pass
-        lines = data.split('\n')
-        ins = len(lines) if len(lines) <= 10 else 10
-        sniffer = csv.Sniffer()
-        self._dialect = sniffer.sniff(lines[0])
-        for line in lines[1:ins]:
-            if line.startswith("#"):
-                if ins == len(lines):
-                    return 'text'
-                ins += 1
-                continue
-            if sniffer.sniff(line).delimiter != self._dialect.delimiter \
-                    or sniffer.sniff(line).quotechar != self._dialect.quotechar:
-                return 'text'
+            pass
+        try:
+            self._dialect = self._sniff_dialect_(lines)
+        except csv.Error:
+            return 'text'
         return 'csv'
 
-    def decode(self, data):
-        result = []
-        if not self._data_type:
-            self._data_type = self._detect_data_type_(data)
+    def decode(self, lines):
+        """
+        Parse records out of an iterable of lines; only the first
+        `SAMPLE_LINES` lines are held in memory to detect the data type,
+        unless the data looks like a JSON document spanning several lines.
+        The detected data type and dialect are remembered, so a decoder
+        can be reused for all the (same format) files of an archive.
+        :param lines: iterable of lines, as byte strings
+        """
+        lines = (_to_text(line) for line in lines)
+        if not self._data_type or (self._data_type == 'csv' and not self._dialect):
+            sample = list(islice(lines, SAMPLE_LINES))
+            if not self._data_type:
+                data_type = self._detect_data_type_(sample)
+                if data_type != 'json' and sample and _starts_json_document(sample[0]):
+                    # possibly a JSON document over several lines, which
+                    # only parsing it in full can tell: read the whole file
+                    sample.extend(lines)
+                    lines = iter(())
+                    obj = _load_json_document(sample)
+                    if obj is not None:
+                        self._data_type = 'json'
+                        for o in _iter_json_records(obj):
+                            yield o
+                        return
+                # 'text' is what we fall back to, try again on the next file
+                if data_type != 'text':
+                    self._data_type = data_type
+            elif not sample:
+                # nothing to parse; sniff the dialect on the next file
+                return
+            else:
+                try:
+                    self._dialect = self._sniff_dialect_(sample)
+                except csv.Error:
+                    # e.g., a single column, with no delimiter to find
+                    print('could not sniff the CSV dialect, assuming comma-separated values')
+                    self._dialect = csv.excel
+            lines = chain(sample, lines)
         if self._data_type == 'csv':
-            for line in self._decode_csv_(data):
-                result.append(line)
+            for line in self._decode_csv_(lines):
+                yield line
         elif self._data_type == 'json':
-            for line in self._decode_json_(data):
-                result.append(line)
-        return result
+            for line in self._decode_json_(lines):
+                yield line
+
+
+class FileSection(io.RawIOBase):
+    """
+    Read-only file-like object over the `size` bytes found at `offset`
+    in file `fp`; closing it leaves `fp` open.
+    """
+
+    def __init__(self, fp, offset, size):
+        super(FileSection, self).__init__()
+        self._fp = fp
+        self._offset = offset
+        self._size = size
+        self.seek(0)
+
+    def read(self, size=-1):
+        remaining = self._size - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self._fp.read(max(size, 0))
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        # the parallel decompressors seek around in the data
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self._size
+        self._fp.seek(self._offset + pos)
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        return self._pos
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+
+class SharedMemoryQueue(object):
+    """
+    Queue-like object handing strings over to another process through
+    fixed-size slots of a shared memory segment: only (slot, length)
+    descriptors travel through the underlying `multiprocessing.Queue`,
+    so the data itself is neither pickled nor copied through a pipe.
+    Other objects, and strings too large for a slot, are put on the
+    queue as they are.
+    """
+
+    def __init__(self, maxsize=0, slots=SHM_SLOTS, slot_size=SHM_SLOT_SIZE):
+        self._queue = Queue(maxsize)
+        # queue of the slots not in use; producers block on it when the
+        # consumer falls behind
+        self._free = Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+        self._slot_size = slot_size
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+
+    def put(self, obj):
+        if isinstance(obj, bytes) and len(obj) <= self._slot_size:
+            slot = self._free.get()
+            start = slot * self._slot_size
+            self._shm.buf[start:start + len(obj)] = obj
+            self._queue.put((slot, len(obj)))
+        else:
+            self._queue.put(obj)
+
+    def get(self):
+        m = self._queue.get()
+        if isinstance(m, tuple):
+            slot, length = m
+            start = slot * self._slot_size
+            m = bytes(self._shm.buf[start:start + length])
+            self._free.put(slot)
+        return m
+
+    def close(self):
+        self._queue.close()
+        self._shm.close()
+        self._shm.unlink()
+
+
+def iter_batches(iterable, size):
+    """
+    Split an iterable into lists of (at most) `size` items.
+    """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def _rewind(fp):
+    try:
+        fp.seek(0)
+        return True
+    except (AttributeError, IOError, ValueError):
+        return False
+
+
+def _iter_decompressed(chunks, new_decompressor):
+    """
+    Decompress data chunks holding one or more compressed streams one
+    after the other (as written, e.g., by pbzip2, or gzip members
+    concatenated), starting a new decompressor at the end of each stream.
+    :param chunks: iterable over compressed data blocks
+    :param new_decompressor: function returning a fresh decompressor object
+    :return: iterator over decompressed data blocks
+    """
+    decompressor = new_decompressor()
+    for chunk in chunks:
+        while chunk:
+            try:
+                data = decompressor.decompress(chunk)
+            except EOFError:
+                # Python 2 `BZ2Decompressor`: the previous stream ended
+                # right at the end of the last chunk
+                decompressor = new_decompressor()
+                continue
+            if data:
+                yield data
+            # Python 2 decompressors have no `eof` attribute, but keep
+            # the data past the end of the stream in `unused_data`
+            if getattr(decompressor, 'eof', bool(decompressor.unused_data)):
+                # skip padding after the stream; more data is another stream
+                chunk = decompressor.unused_data.lstrip(b'\x00')
+                decompressor = new_decompressor()
+            else:
+                chunk = None
+    if hasattr(decompressor, 'flush'):
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+def iter_blocks(fp, parallelization=1):
+    """
+    Read blocks of data from a file object, transparently decompressing
+    bz2 and gzip data on the fly. Seekable streams are handed over to
+    the parallel decompressors `indexed_bzip2` and `rapidgzip` when
+    these are installed.
+    :param fp: file object, as returned by TarFile.extractfile or ZipFile.open
+    :param parallelization: number of threads for the parallel decompressors
+    :return: iterator over (decompressed) data blocks
+    """
+    chunk = fp.read(CHUNK_SIZE)
+    stream = None
+    new_decompressor = None
+    if chunk.startswith(BZ2_MAGIC):
+        if indexed_bzip2 and _rewind(fp):
+            print('decompressing bz2 data stream in parallel')
+            stream = indexed_bzip2.IndexedBzip2File(fp, parallelization=parallelization)
+        else:
+            print('decompressing bz2 data stream')
+            new_decompressor = bz2.BZ2Decompressor
+    elif chunk.startswith(GZIP_MAGIC):
+        if rapidgzip and _rewind(fp):
+            print('decompressing gzip data stream in parallel')
+            stream = rapidgzip.RapidgzipFile(fp, parallelization=parallelization)
+        else:
+            print('decompressing gzip data stream')
+            new_decompressor = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if stream is not None:
+        with closing(stream):
+            chunk = stream.read(CHUNK_SIZE)
+            while chunk:
+                yield chunk
+                chunk = stream.read(CHUNK_SIZE)
+        return
+    chunks = chain((chunk,), iter(lambda: fp.read(CHUNK_SIZE), b''))
+    if new_decompressor is not None:
+        chunks = _iter_decompressed(chunks, new_decompressor)
+    for chunk in chunks:
+        if chunk:
+            yield chunk
+
+
+def iter_lines(fp, parallelization=1):
+    """
+    Read lines (without line terminator) from a (possibly compressed) file object.
+    :param fp: file object, as returned by TarFile.extractfile or ZipFile.open
+    :param parallelization: number of threads for the parallel decompressors
+    :return: iterator over lines, as byte strings
+    """
+    # pieces of the line not terminated yet, joined only once it is, so
+    # that long lines spanning many blocks are not copied over and over
+    pending = []
+    for chunk in iter_blocks(fp, parallelization):
+        lines = chunk.splitlines(True)
+        tail = lines.pop() if lines and not lines[-1].endswith((b'\n', b'\r')) else None
+        if lines and pending:
+            pending.append(lines[0])
+            lines[0] = b''.join(pending)
+            pending = []
+        for line in lines:
+            yield line.rstrip(b'\r\n')
+        if tail is not None:
+            pending.append(tail)
+    if pending:
+        yield b''.join(pending)
 
 
-def extract_file(data_file):
+def extract_file(data_file, decoder, parallelization=1):
     """
      Convert raw 'data' file to actual data 
-     :param data_file: data file
-     :return: data
+     :param data_file: file object to read data from
+     :param decoder: `Decoder` instance to parse the data with
+     :param parallelization: number of threads for the parallel decompressors
+     :return: iterator over data records
      """
-    print('parsing file (size: {0})'.format(len(data_file)))
+    return decoder.decode(iter_lines(data_file, parallelization))
+
+
+def _to_string_value(value):
+    if value is None or isinstance(value, (str, type(u''))):
+        return value
+    return json.dumps(value)
+
+
+def _to_array(values):
+    """
+    Convert a list of JSON values to a `pyarrow` array of the type they
+    share, or to an array of strings if they have none in common
+    (e.g., numbers mixed with text)
+    """
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([_to_string_value(value) for value in values], type=pa.string())
+
+
+def rows_to_table(rows):
+    """
+    Convert a list of decoded records to a `pyarrow.Table`
+    :param rows: list of records (either lists of strings, or dicts)
+    :return: table
+    """
+    if isinstance(rows[0], dict):
+        # one column per key, in order of first appearance
+        names = []
+        seen = set()
+        for row in rows:
+            for name in row:
+                if name not in seen:
+                    seen.add(name)
+                    names.append(name)
+        columns = [_to_array([row.get(name) for row in rows]) for name in names]
+        return pa.Table.from_arrays(columns, names=names)
+    width = max(len(row) for row in rows)
+    columns = [pa.array([(row[n] if n < len(row) else None) for row in rows], type=pa.string())
+               for n in range(width)]
+    return pa.Table.from_arrays(columns, names=['f{0}'.format(n) for n in range(width)])
+
+
+def join_rows(rows):
+    """
+    Join CSV records into a single block of `;`-separated lines
+    :param rows: list of records
+    :return: bytes
+    """
     try:
-        data_file = bz2.decompress(data_file)
-        print('decompressed data to {0}'.format(len(data_file)))
-    except IOError:
-        pass
-    return Decoder().decode(data_file)
+        return b'\n'.join(b';'.join(row) for row in rows)
+    except TypeError:
+        # text values (as parsed on Python 3, or returned by `pyarrow`)
+        return b'\n'.join(b';'.join(_to_bytes(value) for value in row) for row in rows)
 
 
 def post_data_to_writer(data, wq, ot):
     if ot == 'csv':
-        for row in data:
-            wq.put(';'.join(row))
+        # ship rows in batches of newline-separated lines to cut down IPC
+        for batch in iter_batches(data, WRITE_BATCH_SIZE):
+            wq.put(join_rows(batch))
+    elif ot == 'parquet':
+        for batch in iter_batches(data, WRITE_BATCH_SIZE):
+            wq.put(rows_to_table(batch))
     elif ot == 'json':
-        wq.put(json.dumps(dict(data)))
+        # one JSON list of records per line
+        for batch in iter_batches(data, WRITE_BATCH_SIZE):
+            wq.put(json_dumps(batch))
     else:
-        wq.put(str(data))
-
-
-def extract_tar_file(archive_file, ap, wq, ot):
-    print('going to extract archive file {0} from tar {1}'.format(archive_file.name, ap))
-    with tarfile.open(ap) as tf:
-        extracted_archive_file = tf.extractfile(archive_file)
-        if not extracted_archive_file.closed:
-            file_data = extracted_archive_file.read()
-            data = extract_file(file_data)
-            extracted_archive_file.close()
-            post_data_to_writer(data, wq, ot)
+        wq.put(str(list(data)).encode('utf-8'))
+
+
+def iter_tar_files(ap, items, state):
+    """
+    Yield (name, file object) for each of the tar archive `items`, as
+    queued by `_list_archive_files`.
+    :param ap: name of the archive
+    :param items: (name, offset, size) or (name, data) tuples, or `TarInfo` objects
+    :param state: dict caching the archive file objects opened so far
+    """
+    for item in items:
+        if isinstance(item, tarfile.TarInfo):
+            if 'tar' not in state:
+                state['tar'] = tarfile.open(ap)
+            name, size, fp = item.name, item.size, state['tar'].extractfile(item)
+        elif len(item) == 3:
+            if 'raw' not in state:
+                state['raw'] = open(ap, 'rb')
+            name, offset, size = item
+            fp = FileSection(state['raw'], offset, size)
+        else:
+            name, data = item
+            size, fp = len(data), BytesIO(data)
+        with closing(fp):
+            yield name, size, fp
+
+
+def extract_tar_file(archive_file, size, fp, wq, ot, decoder, parallelization=1):
+    print('going to parse archive file {0} from tar (size: {1})'.format(archive_file, size))
+    post_data_to_writer(extract_file(fp, decoder, parallelization), wq, ot)
+
+
+def iter_zip_files(zf, names, executor=None):
+    """
+    Yield (name, file object) for each of the zip archive members `names`.
+    Members up to `PREFETCH_BYTES` are read ahead by the (single thread)
+    `executor`, overlapping I/O and zip decompression with the parsing
+    of the previous member; larger members are streamed from the archive.
+    The archive is never accessed by two threads at the same time.
+    :param zf: open `ZipFile`
+    :param names: names of the archive members
+    :param executor: `ThreadPoolExecutor` with one worker, or None to stream all members
+    """
+    pending = None
+    for name in names:
+        if executor is None or zf.getinfo(name).file_size > PREFETCH_BYTES:
+            if pending is not None:
+                yield pending[0], BytesIO(pending[1].result())
+                pending = None
+            with closing(zf.open(name)) as fp:
+                yield name, fp
         else:
-            print('file pointer not opened, something went wrong for {0} in {1}, skipping..,'.format(archive_file.name, ap))
+            future = executor.submit(zf.read, name)
+            if pending is not None:
+                yield pending[0], BytesIO(pending[1].result())
+            pending = (name, future)
+    if pending is not None:
+        yield pending[0], BytesIO(pending[1].result())
 
 
-def extract_zip_file(archive_file, ap, wq, ot):
-    print('going to extract archive file {0} from zip {1}'.format(archive_file, ap))
-    with ZipFile(ap) as zf:
-        file_data = zf.read(archive_file)
-        data = extract_file(file_data)
-        post_data_to_writer(data, wq, ot)
+def extract_zip_file(archive_file, fp, zf, wq, ot, decoder, parallelization=1):
+    print('going to extract archive file {0} from zip {1}'.format(archive_file, zf.filename))
+    post_data_to_writer(extract_file(fp, decoder, parallelization), wq, ot)
 
 
-def process_archive(ap, fq, wq, ot):
+def process_archive(ap, fq, wq, ot, it, parallelization=1):
     """
     Worker that processes a single file from the archive   
     :param ap: name of the archive
     :param fq: queue to read from
     :param wq: queue to write to
     :param ot: output type
+    :param it: input type, detected from the data if None
+    :param parallelization: number of threads for the parallel decompressors
     """
     print('Starting process_archive indexer named {0}'.format(current_process().name))
+    # files in an archive share format: detect it only once
+    decoder = Decoder(data_type=it)
+    # the archive type does not change, so probe for it only once; zip
+    # archives allow random access: keep them open across files
+    zf = ZipFile(ap) if is_zipfile(ap) else None
+    # tar file data is read straight from the archive file, or comes
+    # already read from the queue: read ahead only for zip archives
+    executor = ThreadPoolExecutor(max_workers=1) if (zf is not None and ThreadPoolExecutor) else None
+    # tar archive file objects, opened on first use
+    tar_state = {}
+    try:
+        while True:
+            batch = fq.get()
+            if batch is None:
+                break
+            if zf is not None:
+                for archive_file, fp in iter_zip_files(zf, batch, executor):
+                    extract_zip_file(archive_file, fp, zf, wq, ot, decoder, parallelization)
+            else:
+                for archive_file, size, fp in iter_tar_files(ap, batch, tar_state):
+                    extract_tar_file(archive_file, size, fp, wq, ot, decoder, parallelization)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if zf is not None:
+            zf.close()
+        for fp in tar_state.values():
+            fp.close()
+
+
+def _write_messages(fp, wq):
     while True:
-        archive_file = fq.get()
-        if isinstance(archive_file, basestring) and archive_file == 'EOP':
+        m = wq.get()
+        if m is None:
             break
-        else:
-            if is_zipfile(ap):
-                extract_zip_file(archive_file, ap, wq, ot)
-            elif tarfile.is_tarfile(ap):
-                extract_tar_file(archive_file, ap, wq, ot)
+        fp.write(m)
+        fp.write(b'\n')
+
+
+def _common_type(types):
+    """
+    Return the type all of `types` can be cast to: integers widen to
+    int64, integers mixed with floats to float64, anything else to string
+    """
+    types = [t for t in types if not pa.types.is_null(t)]
+    if not types:
+        return pa.null()
+    if all(t.equals(types[0]) for t in types):
+        return types[0]
+    if all(pa.types.is_integer(t) for t in types):
+        return pa.int64()
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) for t in types):
+        return pa.float64()
+    return pa.string()
+
+
+def _merge_schemas(schemas):
+    """
+    Return the union of the fields of `schemas`, in order of first
+    appearance, each with the type its values can all be cast to
+    """
+    names = []
+    types = {}
+    for schema in schemas:
+        for field in schema:
+            if field.name not in types:
+                names.append(field.name)
+                types[field.name] = []
+            types[field.name].append(field.type)
+    return pa.schema([(name, _common_type(types[name])) for name in names])
+
+
+def _cast_column(column, type_):
+    try:
+        return column.cast(type_)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        if not pa.types.is_string(type_):
+            raise
+        # e.g., nested values: store them as JSON text
+        return pa.array([_to_string_value(value) for value in column.to_pylist()], type=type_)
+
+
+def _conform_table(table, schema):
+    """
+    Cast a table to `schema`, adding the columns it lacks as nulls
+    """
+    columns = [(_cast_column(table.column(field.name), field.type) if field.name in table.column_names
+                else pa.nulls(table.num_rows, field.type))
+               for field in schema]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def _merge_tables(o, spooled, compression):
+    """
+    Rewrite Parquet file `o` with the rows of the `spooled` files
+    appended, all cast to the union of their schemas
+    """
+    paths = [o] + spooled
+    schema = _merge_schemas([pq.read_schema(path) for path in paths])
+    print('merging {0} tables of different schemas into {1}'.format(len(paths), o))
+    merged = o + '.merge'
+    writer = pq.ParquetWriter(merged, schema, compression=compression)
+    try:
+        for path in paths:
+            pf = pq.ParquetFile(path)
+            for n in range(pf.num_row_groups):
+                writer.write_table(_conform_table(pf.read_row_group(n), schema))
+    finally:
+        writer.close()
+    os.rename(merged, o)
+
 
+def _write_tables(o, wq, compression):
+    """
+    Write tables received on the queue to Parquet file `o`. Tables with
+    the schema of the first one go straight to `o`; the others (e.g.,
+    CSV rows with more fields, JSON records with other keys) are spooled
+    to one temporary file per schema, and merged into `o` at the end.
+    """
+    compression = 'zstd' if compression else 'none'
+    writer = None
+    spool = None
+    # schemas, and writers of the spool files, of the tables not matching `writer`
+    spool_schemas = []
+    spool_writers = []
+    try:
+        while True:
+            m = wq.get()
+            if m is None:
+                break
+            if writer is None:
+                writer = pq.ParquetWriter(o, m.schema, compression=compression)
+                writer.write_table(m)
+            elif m.schema.equals(writer.schema):
+                writer.write_table(m)
+            else:
+                for n, schema in enumerate(spool_schemas):
+                    if m.schema.equals(schema):
+                        break
+                else:
+                    if spool is None:
+                        spool = tempfile.mkdtemp(prefix='archive-etl.', dir=(os.path.dirname(o) or '.'))
+                    n = len(spool_schemas)
+                    spool_schemas.append(m.schema)
+                    spool_writers.append(pq.ParquetWriter(
+                        os.path.join(spool, '{0}.parquet'.format(n)), m.schema, compression='none'))
+                spool_writers[n].write_table(m)
+        if spool_writers:
+            writer.close()
+            for spool_writer in spool_writers:
+                spool_writer.close()
+            _merge_tables(o, [os.path.join(spool, '{0}.parquet'.format(n)) for n in range(len(spool_writers))],
+                          compression)
+    finally:
+        # closing a `ParquetWriter` again is a no-op
+        for spool_writer in spool_writers:
+            spool_writer.close()
+        if writer is not None:
+            writer.close()
+        if spool is not None:
+            shutil.rmtree(spool)
 
-def mp_writer(o, wq, compress):
+
+def mp_writer(o, wq, compression, ot='csv'):
     """
     Multiprocess listener. Listens to message on Queue and writes them to file
     :param o: name of the output file
     :param wq: queue to read from 
-    :param compress: enable or disable compression 
+    :param compression: compression to apply (zstd, bz2), or None to disable it
+    :param ot: output type
     """
-    print('setting up writer for {0} (compression enabled: {1})'.format(o, compress))
-    if compress:
+    print('setting up writer for {0} (compression: {1})'.format(o, compression))
+    if ot == 'parquet':
+        # Parquet files are compressed internally
+        _write_tables(o, wq, compression)
+    elif compression == 'zstd':
+        # `threads=-1` uses as many compression threads as there are CPUs
+        cctx = zstd.ZstdCompressor(level=3, threads=-1)
+        with open(o, 'wb') as raw:
+            with cctx.stream_writer(raw) as fp:
+                _write_messages(fp, wq)
+    elif compression == 'bz2':
         with bz2.BZ2File(o, 'wb') as fp:
-            while True:
-                m = wq.get()
-                if m == 'EOP':
-                    break
-                fp.write('{0}\n'.format(m))
+            _write_messages(fp, wq)
     else:
-        with open(o, 'wb') as fp:
-            while True:
-                m = wq.get()
-                if m == 'EOP':
-                    fp.flush()
-                    break
-                fp.write('{0}\n'.format(m))
-                fp.flush()
+        # let buffered I/O batch the writes; data is flushed on close
+        with open(o, 'wb', WRITE_BUFFER_SIZE) as fp:
+            _write_messages(fp, wq)
 
 
-def queue_archive_files(ap, fq):
+def _list_archive_files(ap):
     """
-    Extract all data and process everything :)
+    Yield the items to hand over to the workers, each with the number of
+    bytes of file data it carries: zip file names; for uncompressed tar
+    archives, (name, offset, size) tuples locating the file data in the
+    archive; for compressed tar archives, (name, data) tuples, or the
+    `TarInfo` of files larger than `TAR_INLINE_BYTES`.
     :param ap: name of the archive
-    :param fq: puts the file names on the queue 
     """
     if is_zipfile(ap):
         with ZipFile(ap, 'r') as archive:
             for archive_file in archive.namelist():
                 if not archive_file.endswith('/') and ZipFile.getinfo(archive, archive_file).file_size > 0:
-                    fq.put(archive_file)
+                    yield archive_file, 0
     elif tarfile.is_tarfile(ap):
-        with tarfile.open(ap) as archive:
+        try:
+            archive = tarfile.open(ap, 'r:')
+            compressed = False
+        except tarfile.ReadError:
+            archive = tarfile.open(ap)
+            compressed = True
+        with archive:
             for archive_file in archive:
-                if archive_file.isreg() and archive_file.size > 0:
-                    fq.put(archive_file)
+                if not archive_file.isreg() or archive_file.size == 0:
+                    continue
+                if not (compressed or archive_file.issparse()):
+                    yield (archive_file.name, archive_file.offset_data, archive_file.size), 0
+                elif archive_file.size > TAR_INLINE_BYTES:
+                    yield archive_file, 0
+                else:
+                    # the archive is decompressed only once, here
+                    with closing(archive.extractfile(archive_file)) as fp:
+                        data = fp.read()
+                    yield (archive_file.name, data), len(data)
     else:
         raise IOError('could not match {0} to zip or tar format'.format(ap))
 
 
+def queue_archive_files(ap, fq):
+    """
+    Extract all data and process everything :)
+    Zip file names, and the location of the files in uncompressed tar
+    archives, are queued for the workers to read the data themselves;
+    compressed tar archives are read sequentially (in a single pass)
+    here, and the queue gets (name, data) tuples for the workers to
+    parse, save for large files (see `_list_archive_files`).
+    Items are put on the queue in batches of up to `FILE_BATCH_SIZE`
+    files, or `FILE_BATCH_BYTES` bytes of file data.
+    :param ap: name of the archive
+    :param fq: puts the file names (or contents) on the queue 
+    """
+    batch = []
+    batch_bytes = 0
+    for item, size in _list_archive_files(ap):
+        batch.append(item)
+        batch_bytes += size
+        if len(batch) == FILE_BATCH_SIZE or batch_bytes >= FILE_BATCH_BYTES:
+            fq.put(batch)
+            batch = []
+            batch_bytes = 0
+    if batch:
+        fq.put(batch)
+
+
 if __name__ == "__main__":
+    # start workers from a small server process with the heavy modules
+    # already imported, rather than forking this whole process (Python 3);
+    # preloading this script imports exactly the optional modules found here
+    if 'forkserver' in getattr(multiprocessing, 'get_all_start_methods', list)():
+        multiprocessing.set_start_method('forkserver')
+        multiprocessing.set_forkserver_preload(['__main__'])
     # wait {timeout} seconds for our file to become available
     parser = argparse.ArgumentParser(description='Extract data from zip/tar and parse into a single file')
     parser.add_argument('-a', '--archive', help='path to the archive', required=True)
@@ -190,11 +892,17 @@ if __name__ == "__main__":
                                                   'default: %(default)d.', type=int, default=cpu_count())
     parser.add_argument('-t', '--time-out', help='waiting time in seconds for the archive to become available, '
                                                  'default: %(default)d.', type=int, default=360)
-    parser.add_argument('-f', '--output-format', help='format in which to write the output file (csv, json, text), '
+    parser.add_argument('-f', '--output-format', help='format in which to write the output file (csv, json, text, parquet), '
                                                       'default: %(default)s.', default='csv')
-    parser.add_argument('-n', '--no-compression', help='do not compress output file as bz2', action='store_true')
+    parser.add_argument('-F', '--input-format', help='format of the archived data files (csv, json, text), '
+                                                     'detected from the data if not given.',
+                        choices=('csv', 'json', 'text'), default=None)
+    parser.add_argument('-n', '--no-compression', help='do not compress output file', action='store_true')
+    parser.add_argument('--legacy-bz2', help='compress output file as bz2 instead of zstd', action='store_true')
     parser.add_argument('-o', '--output', help='directory output path of the single columnar file')
     args = parser.parse_args()
+    if args.output_format == 'parquet' and pa is None:
+        parser.error('output format parquet requires the pyarrow module')
 
     archive_path = os.path.expanduser(os.path.expandvars(args.archive))
     timeout = args.time_out
@@ -208,25 +916,38 @@ if __name__ == "__main__":
         time.sleep(1)
 
     print('setting up multiprocessing')
-    manager = Manager()
-    file_queue = manager.Queue()
-    writer_queue = manager.Queue()
+    # plain (pipe-backed) queues are much cheaper than `Manager()`
+    # proxies; bounding them also caps the memory used for buffering
+    file_queue = Queue(maxsize=4 * args.processors)
+    if shared_memory is not None:
+        writer_queue = SharedMemoryQueue(maxsize=1024)
+    else:
+        writer_queue = Queue(maxsize=1024)
     indexer = Process(target=queue_archive_files, args=(archive_path, file_queue,))
     indexer.start()
-    output_file_ext = '{of}.bz2'.format(of=args.output_format)
-    if args.no_compression:
+    if args.output_format == 'parquet':
+        compression = None if args.no_compression else 'zstd'
         output_file_ext = args.output_format
+    elif args.no_compression:
+        compression = None
+        output_file_ext = args.output_format
+    else:
+        compression = 'bz2' if (args.legacy_bz2 or zstd is None) else 'zstd'
+        output_file_ext = '{of}.{ce}'.format(of=args.output_format, ce=('zst' if compression == 'zstd' else 'bz2'))
     output_file = '{fn}.{ext}'.format(fn=os.path.splitext(os.path.basename(args.archive))[0], ext=output_file_ext)
     if args.output:
         output_file = os.path.join(args.output, '{fn}.{ext}'.format(fn=os.path.basename(args.archives),
                                                                     ext=output_file_ext))
-    compression = True if not args.no_compression else False
-    writer = Process(target=mp_writer, args=(output_file, writer_queue, compression,))
+    writer = Process(target=mp_writer, args=(output_file, writer_queue, compression, args.output_format,))
     writer.start()
     print('Setup file processors and start crunching')
+    # share the CPUs among the workers' decompression threads
+    parallelization = max(1, cpu_count() // args.processors)
     jobs = []
     for index in range(0, args.processors):
-        jobs.append(Process(target=process_archive, args=(archive_path, file_queue, writer_queue, args.output_format)))
+        jobs.append(Process(target=process_archive, args=(archive_path, file_queue, writer_queue,
+                                                          args.output_format, args.input_format,
+                                                          parallelization)))
     for job in jobs:
         job.start()
         print('Started process {0} in pid {1}'.format(job.name, job.pid))
@@ -234,11 +955,20 @@ if __name__ == "__main__":
     indexer.join()
     print('add terminators to index file queue (as last element)')
     for job in jobs:
-        file_queue.put('EOP')
+        file_queue.put(None)
     print('wait for our processors to finish')
     for job in jobs:
         job.join()
     print('and now add terminator for writer and wait to finish')
-    writer_queue.put('EOP')
+    writer_queue.put(None)
     writer.join()
+    writer_queue.close()
+    failed = [job.name for job in jobs if job.exitcode]
+    if failed:
+        print('processing {0} failed in {1}, please check the log for errors'.format(archive_path,
+                                                                                 ', '.join(failed)))
+        exit(-1)
+    if writer.exitcode:
+        print('writing {0} failed, please check the log for errors'.format(output_file))
+        exit(-1)
     print('Elvis has left the building')
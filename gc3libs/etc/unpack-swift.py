@@ -1,30 +1,297 @@
 #!/usr/bin/python
 # Extract an archive and write the contents of it to Swift Object Storage
 import argparse
+import json
 import os
 import tarfile
+import threading
 import time
-from multiprocessing import Manager, Process, current_process, cpu_count
+from collections import deque
+from contextlib import closing
+from io import BytesIO
+from multiprocessing import Process, Queue, current_process, cpu_count
 from zipfile import ZipFile, is_zipfile
 
-import swiftclient
+try:
+    from urllib.parse import unquote
+except ImportError:
+    # Python 2
+    from urllib import unquote
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # uploads are done one at a time by the worker process
+    ThreadPoolExecutor = None
 
-def extract_tar_file(archive_file, ap):
-    print('going to extract archive file {0} from tar {1}'.format(archive_file.name, ap))
-    with tarfile.open(ap) as tf:
-        extracted_archive_file = tf.extractfile(archive_file)
-        if not extracted_archive_file.closed:
-            yield extracted_archive_file.read()
-            extracted_archive_file.close()
-        else:
-            print('file pointer not opened, something went wrong for {0} in {1}, skipping..,'.format(archive_file.name, ap))
+# number of archive files handed to a worker at once
+FILE_BATCH_SIZE = 128
+# files up to this size are collected and uploaded in bulk, at most
+# `BULK_MAX_FILES` files or `BULK_MAX_BYTES` bytes at a time
+BULK_MAX_FILE_SIZE = 1 << 20
+BULK_MAX_FILES = 1000
+BULK_MAX_BYTES = 64 << 20
+# number of bulk uploads in flight per worker while the next one is
+# collected; each holds up to `BULK_MAX_BYTES` in memory
+BULK_MAX_PENDING = 1
+# number of upload threads per worker, and largest file uploaded by them
+# (it has to be read in memory first); larger files are streamed
+UPLOAD_THREADS = 8
+THREADED_MAX_FILE_SIZE = 16 << 20
+# end-of-processing marker on the file queue; items are pickled on their way
+# to the workers, so a unique `object()` would not compare identical there
+EOP = None
+
+
+class FileSection(object):
+    """
+    Read-only file-like object over the `size` bytes found at `offset`
+    in file `fp`; closing it leaves `fp` open.
+    """
+
+    def __init__(self, fp, offset, size):
+        self._fp = fp
+        self._offset = offset
+        self._size = size
+        self.seek(0)
+
+    def read(self, size=-1):
+        remaining = self._size - self._pos
+        if size < 0 or size > remaining:
+            size = remaining
+        data = self._fp.read(size)
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos):
+        # swiftclient rewinds the data to retry an upload
+        self._fp.seek(self._offset + pos)
+        self._pos = pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        pass
+
+
+class ZipMember(object):
+    """
+    Read-only file-like object over member `info` of zip archive `zf`.
+    Unlike the stream returned by `ZipFile.open` (whose `tell` raises
+    `io.UnsupportedOperation` on Python 2), it can be rewound, which it
+    does by opening the member anew.
+    """
+
+    def __init__(self, zf, info):
+        self._zf = zf
+        self._info = info
+        self._fp = None
+        self.seek(0)
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos):
+        # swiftclient rewinds the data to retry an upload
+        self.close()
+        self._fp = self._zf.open(self._info)
+        self._pos = 0
+        while self._pos < pos and self.read(min(pos - self._pos, 1 << 20)):
+            pass
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+
+
+class BulkUpload(object):
+    """
+    Collect small files into an in-memory tar archive, which is uploaded
+    with a single request and unpacked into separate objects by the
+    Swift bulk middleware (``?extract-archive=tar``). Files that the
+    middleware fails to store are uploaded again, one by one.
+    At most `BULK_MAX_PENDING` archives are uploaded at a time.
+    """
+
+    def __init__(self, run, container):
+        """
+        :param run: function calling its first argument with a Swift connection
+                    (and the remaining arguments), e.g., `ThreadedUpload.run`
+        :param container: container to upload to
+        """
+        self._run = run
+        self._container = container
+        # upload slots, released by `_upload` (possibly in another thread)
+        self._slots = threading.BoundedSemaphore(BULK_MAX_PENDING)
+        self._reset()
+
+    def _reset(self):
+        self._buffer = BytesIO()
+        self._tar = tarfile.open(fileobj=self._buffer, mode='w')
+        # object name -> (offset, size) of its data in the archive
+        self._files = {}
+
+    def add(self, name, fp, size):
+        """
+        Append `size` bytes read from `fp` as object `name`; upload the
+        collected files once `BULK_MAX_FILES` or `BULK_MAX_BYTES` are reached.
+        """
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = time.time()
+        self._tar.addfile(info, fp)
+        # file data is padded to a whole number of blocks
+        end = self._buffer.tell()
+        self._files[name] = (end - (size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE, size)
+        if len(self._files) >= BULK_MAX_FILES or end >= BULK_MAX_BYTES:
+            self.flush()
+
+    def flush(self):
+        if not self._files:
+            return
+        self._tar.close()
+        data, files = self._buffer.getvalue(), self._files
+        # drop the buffer before waiting, it is copied in `data`
+        self._reset()
+        self._slots.acquire()
+        print('uploading {0} files to {1} in a single bulk request'.format(len(files), self._container))
+        self._run(self._upload, data, files)
 
+    def _upload(self, swift_conn, data, files):
+        from swiftclient.client import ClientException
+        try:
+            try:
+                failed = _extract_archive(swift_conn, self._container, data)
+            except (ClientException, IOError) as err:
+                print('bulk upload to {0} failed: {1}'.format(self._container, err))
+                failed = None
+            if failed is None or not all(name in files for name, _ in failed):
+                failed = [(name, 'not extracted') for name in files]
+            for name, status in failed:
+                print('uploading {0} to {1} again ({2})'.format(name, self._container, status))
+                offset, size = files[name]
+                swift_conn.put_object(self._container, name, contents=BytesIO(data[offset:offset + size]),
+                                      content_length=size)
+        finally:
+            self._slots.release()
 
-def extract_zip_file(archive_file, ap):
-    print('going to extract archive file {0} from zip {1}'.format(archive_file, ap))
-    with ZipFile(ap) as zf:
-        yield zf.read(archive_file)
+
+class ThreadedUpload(object):
+    """
+    Run `put_object` calls in a pool of threads, so that uploads proceed
+    while the worker extracts the next files. Each thread uses its own
+    Swift connection, as `swiftclient.Connection` is not thread-safe.
+    When `UPLOAD_THREADS` uploads are in flight, `put_object` waits for
+    the oldest one to complete.
+    """
+
+    def __init__(self, connect):
+        """
+        :param connect: function returning a new Swift connection
+        """
+        self._connect = connect
+        self._local = threading.local()
+        self._connections = []
+        self._pool = ThreadPoolExecutor(max_workers=UPLOAD_THREADS)
+        self._pending = deque()
+
+    def _run_in_thread(self, func, *args, **kwargs):
+        swift_conn = getattr(self._local, 'swift_conn', None)
+        if swift_conn is None:
+            swift_conn = self._local.swift_conn = self._connect()
+            self._connections.append(swift_conn)
+        return func(swift_conn, *args, **kwargs)
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call `func` with the thread's Swift connection as first argument.
+        """
+        self._pending.append(self._pool.submit(self._run_in_thread, func, *args, **kwargs))
+        if len(self._pending) > UPLOAD_THREADS:
+            self._pending.popleft().result()
+
+    def put_object(self, *args, **kwargs):
+        self.run(lambda swift_conn: swift_conn.put_object(*args, **kwargs))
+
+    def close(self):
+        """
+        Wait for all uploads to complete (re-raising their errors) and close the connections.
+        """
+        try:
+            while self._pending:
+                self._pending.popleft().result()
+        finally:
+            self._pool.shutdown()
+            for swift_conn in self._connections:
+                swift_conn.close()
+
+
+def _connect(sc, preauth=(None, None)):
+    """
+    Return a new Swift connection
+    :param sc: swift connection data
+    :param preauth: storage URL and auth token to reuse, as returned by `Connection.get_auth`
+    """
+    # only the workers talk to Swift: import the client here, so that the
+    # main and indexer processes do not load its dependencies
+    from swiftclient.client import Connection
+    preauthurl, preauthtoken = preauth
+    return Connection(authurl=sc['auth'],
+                      user=sc['user'],
+                      key=sc['sess'],
+                      tenant_name=sc['proj'],
+                      auth_version='2.0',
+                      preauthurl=preauthurl,
+                      preauthtoken=preauthtoken,
+                      retries=2,
+                      starting_backoff=0.5)
+
+
+def _extract_archive(swift_conn, container, data):
+    """
+    Upload tar archive `data` with the Swift bulk "extract-archive"
+    operation, which unpacks it into objects of `container`.
+
+    The bulk middleware answers 200 OK and reports the outcome in the
+    response body: return the (object name, status) of each file it
+    failed to store, or None if the archive was rejected as a whole.
+    """
+    from swiftclient.client import ClientException, quote
+    parsed, conn = swift_conn.http_connection()
+    path = '{0}/{1}?extract-archive=tar'.format(parsed.path, quote(container))
+    try:
+        conn.request('PUT', path, data, {'X-Auth-Token': swift_conn.token,
+                                         'Accept': 'application/json'})
+        resp = conn.getresponse()
+        body = resp.read()
+    finally:
+        conn.close()
+    if resp.status < 200 or resp.status >= 300:
+        raise ClientException('Bulk upload failed', http_status=resp.status,
+                              http_reason=resp.reason, http_response_content=body)
+    result = json.loads(body.decode('utf-8'))
+    if result['Response Status'].startswith('2'):
+        return []
+    if not result.get('Errors'):
+        print('bulk upload to {0} rejected: {1} {2}'.format(
+            container, result['Response Status'], result.get('Response Body', '')))
+        return None
+    # errors are reported by (quoted) object path: /container/name
+    return [(unquote(obj_path).split('/', 2)[2], status) for obj_path, status in result['Errors']]
+
+
+def _bulk_upload_supported(swift_conn):
+    from swiftclient.client import ClientException
+    try:
+        return 'bulk_upload' in swift_conn.get_capabilities()
+    except ClientException:
+        return False
 
 
 def process_archive(ap, fq, sc, con, pf):
@@ -37,43 +304,112 @@ def process_archive(ap, fq, sc, con, pf):
     :param pf: prefix 
     """
     print('Starting process_archive indexer named {0}'.format(current_process().name))
-    with swiftclient.client.Connection(authurl=sc['auth'],
-                                       user=sc['user'],
-                                       key=sc['sess'],
-                                       tenant_name=sc['proj'],
-                                       auth_version='2.0') as swift_conn:
-        while True:
-            archive_file = fq.get()
-            if isinstance(archive_file, basestring) and archive_file == 'EOP':
-                break
-            else:
-                if is_zipfile(ap):
-                    data = extract_zip_file(archive_file, ap)
-                else:
-                    data = extract_tar_file(archive_file, ap)
-                swift_conn.put_object(con, '{prefix}{path}'.format(prefix=pf, path=archive_file), data)
+    # open the archive only once per worker; files of uncompressed tar
+    # archives are read right from the archive file, bypassing `tarfile`
+    is_zip = is_zipfile(ap)
+    archive = ZipFile(ap) if is_zip else open(ap, 'rb')
+    tf = None
+    with archive, closing(_connect(sc)) as swift_conn:
+        # authenticate once, up front: the upload threads' connections reuse
+        # the token (they re-authenticate by themselves should it expire)
+        preauth = swift_conn.get_auth()
+        threaded = ThreadedUpload(lambda: _connect(sc, preauth)) if ThreadPoolExecutor else None
+        if threaded is not None:
+            run = threaded.run
+        else:
+            run = lambda func, *args: func(swift_conn, *args)
+        # small files are uploaded in batches where the cluster allows it
+        bulk = BulkUpload(run, con) if _bulk_upload_supported(swift_conn) else None
+        try:
+            while True:
+                batch = fq.get()
+                if batch is EOP:
+                    break
+                for archive_file in batch:
+                    if is_zip:
+                        name, size = archive_file.filename, archive_file.file_size
+                        fp = ZipMember(archive, archive_file)
+                    elif isinstance(archive_file, tuple):
+                        name, offset, size = archive_file
+                        fp = FileSection(archive, offset, size)
+                    else:
+                        # compressed tar archive or sparse file
+                        if tf is None:
+                            tf = tarfile.open(ap)
+                        name, size = archive_file.name, archive_file.size
+                        fp = tf.extractfile(archive_file)
+                    print('going to extract archive file {0} from {1}'.format(name, ap))
+                    key = '{prefix}{path}'.format(prefix=(pf or ''), path=name)
+                    with closing(fp):
+                        if bulk is not None and size <= BULK_MAX_FILE_SIZE:
+                            bulk.add(key, fp, size)
+                        elif threaded is not None and size <= THREADED_MAX_FILE_SIZE:
+                            # the archive cannot be read from several threads:
+                            # read the data here, upload it in the background;
+                            # swiftclient can rewind a file object to retry, but
+                            # not `bytes` (on Python 3)
+                            threaded.put_object(con, key, contents=BytesIO(fp.read(size)),
+                                                content_length=size)
+                        else:
+                            # hand the file object over to swiftclient, which uploads
+                            # it in chunks, instead of reading all the data in memory
+                            swift_conn.put_object(con, key, contents=fp, content_length=size)
+            if bulk is not None:
+                bulk.flush()
+        finally:
+            if threaded is not None:
+                threaded.close()
+            if tf is not None:
+                tf.close()
 
 
-def queue_archive_files(ap, fq):
+def _list_archive_files(ap):
     """
-    Extract all archive content names and put them on a queue
+    Yield the `ZipInfo`/`TarInfo` objects of the (non-empty) files in the archive;
+    for uncompressed tar archives, yield (name, offset, size) tuples locating
+    the file data in the archive instead, so workers can read it directly
     :param ap: name of the archive
-    :param fq: puts the file names on the queue 
     """
     if is_zipfile(ap):
         with ZipFile(ap, 'r') as archive:
-            for archive_file in archive.namelist():
-                if not archive_file.endswith('/') and ZipFile.getinfo(archive, archive_file).file_size > 0:
-                    fq.put(archive_file)
+            for archive_file in archive.infolist():
+                if not archive_file.filename.endswith('/') and archive_file.file_size > 0:
+                    yield archive_file
     elif tarfile.is_tarfile(ap):
-        with tarfile.open(ap) as archive:
+        try:
+            archive = tarfile.open(ap, 'r:')
+            compressed = False
+        except tarfile.ReadError:
+            archive = tarfile.open(ap)
+            compressed = True
+        with archive:
             for archive_file in archive:
                 if archive_file.isreg() and archive_file.size > 0:
-                    fq.put(archive_file)
+                    if compressed or archive_file.issparse():
+                        yield archive_file
+                    else:
+                        yield archive_file.name, archive_file.offset_data, archive_file.size
     else:
         raise IOError('could not match {0} to zip or tar format'.format(ap))
 
 
+def queue_archive_files(ap, fq):
+    """
+    Extract all archive content infos and put them on a queue,
+    in batches of `FILE_BATCH_SIZE`
+    :param ap: name of the archive
+    :param fq: puts lists of file infos on the queue 
+    """
+    batch = []
+    for archive_file in _list_archive_files(ap):
+        batch.append(archive_file)
+        if len(batch) == FILE_BATCH_SIZE:
+            fq.put(batch)
+            batch = []
+    if batch:
+        fq.put(batch)
+
+
 if __name__ == "__main__":
     # wait {timeout} seconds for our file to become available
     parser = argparse.ArgumentParser(description='Extract data from zip/tar to a Swift container.')
@@ -89,7 +425,7 @@ if __name__ == "__main__":
     with open('amaterial.dat', 'r') as os_file:
         for line in os_file:
             name, var = line.partition("=")[::2]
-            os_vars[name.strip()] = var
+            os_vars[name.strip()] = var.strip()
 
     archive_path = os.path.expanduser(os.path.expandvars(args.archive))
     timeout = args.time_out
@@ -103,8 +439,9 @@ if __name__ == "__main__":
         time.sleep(1)
 
     print('setting up multiprocessing')
-    manager = Manager()
-    file_queue = manager.Queue()
+    # a plain (pipe-backed) queue is much cheaper than a `Manager()`
+    # proxy; bounding it keeps the indexer from buffering the whole index
+    file_queue = Queue(maxsize=10000)
     indexer = Process(target=queue_archive_files, args=(archive_path, file_queue,))
     indexer.start()
     print('Setup file processors {0} and start crunching'.format(args.num_cores))
@@ -122,7 +459,7 @@ if __name__ == "__main__":
     indexer.join()
     print('add terminators to index file queue (as last element)')
     for job in jobs:
-        file_queue.put('EOP')
+        file_queue.put(EOP)
     print('wait for our processors to finish')
     for job in jobs:
         job.join()
@@ -36,12 +36,25 @@ from gc3libs.persistence.store import Persistable
 DEFAULT_PROTOCOL = pickle.HIGHEST_PROTOCOL
 
 
-def make_pickler(driver, stream, root, protocol=pickle.HIGHEST_PROTOCOL):
+def make_pickler(driver, stream, root, protocol=DEFAULT_PROTOCOL):
     p = pickle.Pickler(stream, protocol=protocol)
     p.persistent_id = _PersistentIdToSave(driver, root)
     return p
 
 
+def dumps(driver, root, protocol=DEFAULT_PROTOCOL):
+    """
+    Return the pickled representation of `root` as a string; like
+    `make_pickler`, save referenced `Persistable` objects via `driver`.
+    """
+    # a *cPickle* pickler created with no stream accumulates the output
+    # internally, which spares allocating and copying out of a `StringIO`
+    p = pickle.Pickler(protocol)
+    p.persistent_id = _PersistentIdToSave(driver, root)
+    p.dump(root)
+    return p.getvalue()
+
+
 def make_unpickler(driver, stream):
     p = pickle.Unpickler(stream)
     p.persistent_load = _PersistentLoadExternalId(driver)
@@ -24,52 +24,145 @@ __docformat__ = 'reStructuredText'
 
 
 # stdlib imports
-from contextlib import closing
 from cStringIO import StringIO
+import logging
 import os
+from urllib import urlencode
+from urlparse import parse_qsl
 from warnings import warn
 
 import sqlalchemy as sqla
+from sqlalchemy import event
+from sqlalchemy.pool import SingletonThreadPool
 import sqlalchemy.sql as sql
 
 # GC3Pie interface
 from gc3libs import Run
+from gc3libs.compat._collections import OrderedDict
 import gc3libs.exceptions
 import gc3libs.utils
 from gc3libs.utils import same_docstring_as
 
 from gc3libs.persistence.idfactory import IdFactory
-from gc3libs.persistence.serialization import make_pickler, make_unpickler
+from gc3libs.persistence.serialization import dumps, make_unpickler
 from gc3libs.persistence.store import Store
 
 
-def sql_next_id_factory(db):
+def sql_next_id_factory(db, table_name='store'):
     """
     This function will return a function which can be used as
     `next_id_fn` argument for the `IdFactory` class constructor.
 
-    `db` is DB connection class conform to DB API2.0 specs (works also
-    with SQLAlchemy engine types)
+    `db` is a SQLAlchemy engine (or connection) to the DB holding
+    table `table_name`.
 
     The function returned has signature:
 
-        sql_next_id(n=1)
+        sql_next_id(qty=None)
 
-    the id returned is the maximum `id` field in the `store` table plus
-    1.
+    and, like `gc3libs.utils.progressive_number`:func:, returns a
+    single id or a list of `qty` ids.  Ids are allocated by the DB
+    itself: each one is the auto-incremented key of a new, empty row
+    in table `table_name`, which `SqlStore.save` later fills in.
+    Unlike computing ``MAX(id)+1``, this needs no table scan and never
+    hands out the same id twice, even to concurrent processes.
+
+    Only the newest reserved row is kept, so that the DB does not hand
+    out ids below it again; the older ones are deleted as soon as a
+    new id is allocated, unless `SqlStore.save` has filled them in
+    already.  (`SqlStore.save` inserts the row again if it is gone.)
     """
-    def sql_next_id(n=1):
-        q = db.execute('select max(id) from store')
-        nextid = q.fetchone()[0]
-        if not nextid:
-            nextid = 1
-        else:
-            nextid = int(nextid) + 1
-        return nextid
+    table = sqla.Table(
+        table_name, sqla.MetaData(),
+        sqla.Column('id', sqla.Integer(), primary_key=True),
+        sqla.Column('data', sqla.LargeBinary()))
+    q = table.insert().values(data=None)
+    # ids reserved by the previous call and not yet released
+    reserved = []
+
+    def sql_next_id(qty=None):
+        ids = [db.execute(q).inserted_primary_key[0]
+               for _ in range(qty or 1)]
+        stale = reserved + ids[:-1]
+        if stale:
+            db.execute(table.delete()
+                       .where(table.c.id.in_(stale))
+                       .where(table.c.data.is_(None)))
+        reserved[:] = ids[-1:]
+        if qty is None:
+            return ids[0]
+        return ids
 
     return sql_next_id
 
 
+def _pop_url_param(url, name):
+    """
+    Remove query parameter `name` from URL string `url`; return the
+    resulting URL and the parameter value (``None`` if not present).
+    """
+    base, _, query = url.partition('?')
+    value = None
+    params = []
+    for key, val in parse_qsl(query, keep_blank_values=True):
+        if key == name:
+            value = val
+        else:
+            params.append((key, val))
+    if params:
+        base += '?' + urlencode(params)
+    return base, value
+
+
+def _sqlite_pragmas_setter(wal):
+    """
+    Return a "connect" event listener tuning new SQLite connections
+    for a write-often DB; if `wal` is true, also switch the DB to
+    write-ahead logging.
+    """
+    def set_sqlite_pragmas(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        if wal:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            # fewer fsyncs are only safe against power loss in WAL
+            # mode; otherwise keep SQLite's default (FULL)
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
+    return set_sqlite_pragmas
+
+
+def _upsert_insert_for(engine):
+    """
+    Return the `insert` construct of `engine`'s SQL dialect, if it
+    supports "insert or update" clauses; return ``None`` otherwise,
+    or if the installed SQLAlchemy or SQLite are too old to use it.
+    """
+    dialect = engine.dialect.name
+    try:
+        if dialect == 'sqlite':
+            # ``INSERT ... ON CONFLICT`` is only available since SQLite 3.24
+            if engine.dialect.dbapi.sqlite_version_info < (3, 24):
+                return None
+            from sqlalchemy.dialects.sqlite import insert
+        elif dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+        else:
+            return None
+    except ImportError:
+        return None
+    return insert
+
+
+KNOWN_IDS_MAX = 10000
+"""
+How many IDs of existing objects a `SqlStore`:class: remembers, so
+as to save them without first probing the DB for their row.
+"""
+
+
 class IntId(int):
 
     def __new__(cls, prefix, seqno):
@@ -136,6 +229,11 @@ class SqlStore(Store):
     corresponding *function* in order to get the correct value to
     store into the DB.
 
+    For SQLite databases, parameter ``wal=yes`` in the `url` query
+    string (e.g., ``sqlite:////path/to/store.db?wal=yes``) switches the
+    DB file to write-ahead logging, which is faster but persistent and
+    not supported on network filesystems.
+
     Any extra keyword arguments are ignored for compatibility with
     `FilesystemStore`:class:.
     """
@@ -164,7 +262,17 @@ class SqlStore(Store):
         # create slots for lazy-init'ed attrs
         self._real_engine = None
         self._real_extra_fields = None
+        self._real_extra_fields_items = None
         self._real_tables = None
+        self._real_upsert_insert = None
+        self._q_list = None
+        self._q_load = None
+        self._q_exists = None
+        self._q_delete = None
+        self._q_save = {}
+
+        # IDs known to be in the DB, most recently used last
+        self._known_ids = OrderedDict()
 
     def _delayed_init(self):
         """
@@ -175,7 +283,17 @@ class SqlStore(Store):
         <https://github.com/uzh/gc3pie/issues/550>`_ for more details
         and motivation.
         """
-        self._real_engine = sqla.create_engine(str(self.url))
+        url = str(self.url)
+        if url.startswith('sqlite'):
+            url, wal = _pop_url_param(url, 'wal')
+            # keep the DB file open (one connection per thread) instead
+            # of opening it again for every store operation
+            self._real_engine = sqla.create_engine(
+                url, poolclass=SingletonThreadPool)
+            event.listen(self._real_engine, 'connect', _sqlite_pragmas_setter(
+                wal is not None and gc3libs.utils.string_to_boolean(wal)))
+        else:
+            self._real_engine = sqla.create_engine(url)
 
         # create schema
         meta = sqla.MetaData(bind=self._real_engine)
@@ -184,11 +302,14 @@ class SqlStore(Store):
             meta,
             sqla.Column('id',
                         sqla.Integer(),
-                        primary_key=True, nullable=False),
+                        primary_key=True, nullable=False,
+                        autoincrement=True),
             sqla.Column('data',
                         sqla.LargeBinary()),
             sqla.Column('state',
-                        sqla.String(length=128)))
+                        sqla.String(length=128)),
+            # never re-use the ids of deleted rows
+            sqlite_autoincrement=True)
 
         # create internal rep of table
         self._real_extra_fields = {}
@@ -196,6 +317,7 @@ class SqlStore(Store):
             assert isinstance(col, sqla.Column)
             table.append_column(col.copy())
             self._real_extra_fields[col.name] = func
+        self._real_extra_fields_items = tuple(self._real_extra_fields.items())
 
         # check if the db exists and already has a 'store' table
         current_meta = sqla.MetaData(bind=self._real_engine)
@@ -204,6 +326,17 @@ class SqlStore(Store):
             meta.create_all()
 
         self._real_tables = meta.tables[self.table_name]
+        self._real_upsert_insert = _upsert_insert_for(self._real_engine)
+
+        # compile queries once; the object ID is passed as parameter `id_`
+        t = self._real_tables
+        by_id = (t.c.id == sql.bindparam('id_', type_=sqla.Integer()))
+        # skip ids reserved by `sql_next_id_factory` but not saved (yet)
+        self._q_list = sql.select([t.c.id]).where(
+            t.c.data.isnot(None)).compile(self._real_engine)
+        self._q_load = sql.select([t.c.data]).where(by_id).compile(self._real_engine)
+        self._q_exists = sql.select([t.c.id]).where(by_id).compile(self._real_engine)
+        self._q_delete = t.delete().where(by_id).compile(self._real_engine)
 
 
     @property
@@ -234,15 +367,54 @@ class SqlStore(Store):
             self._delayed_init()
         return self._real_extra_fields
 
+    @property
+    def _extra_fields_items(self):
+        if self._real_extra_fields_items is None:
+            self._delayed_init()
+        return self._real_extra_fields_items
+
+
+    def _save_stmt(self, kind, columns):
+        """
+        Return the compiled statement writing the object ID and
+        `columns` into the store table.
+
+        Argument `kind` is one of: ``'insert'``, ``'update'`` (of the
+        row whose ID is given as parameter `id_`), or ``'upsert'``
+        (insert a row, or update `columns` of the row with the same ID
+        if it exists; needs a DB dialect supporting it).  Statements are
+        cached, keyed by `kind` and the `columns` tuple.
+        """
+        stmt = self._q_save.get((kind, columns))
+        if stmt is None:
+            t = self._tables
+            if kind == 'update':
+                stmt = t.update().where(
+                    t.c.id == sql.bindparam('id_', type_=sqla.Integer()))
+                column_keys = columns
+            else:
+                column_keys = ('id',) + columns
+                if kind == 'insert':
+                    stmt = t.insert()
+                else:
+                    stmt = self._real_upsert_insert(t)
+                    if hasattr(stmt, 'on_conflict_do_update'):
+                        # SQLite, PostgreSQL
+                        stmt = stmt.on_conflict_do_update(
+                            index_elements=[t.c.id],
+                            set_=dict((col, stmt.excluded[col]) for col in columns))
+                    else:
+                        # MySQL
+                        stmt = stmt.on_duplicate_key_update(
+                            **dict((col, stmt.inserted[col]) for col in columns))
+            stmt = stmt.compile(self._engine, column_keys=column_keys)
+            self._q_save[kind, columns] = stmt
+        return stmt
 
     @same_docstring_as(Store.list)
     def list(self):
-        q = sql.select([self._tables.c.id])
-        conn = self._engine.connect()
-        rows = conn.execute(q)
-        ids = [i[0] for i in rows.fetchall()]
-        conn.close()
-        return ids
+        with self._engine.begin() as conn:
+            return [row[0] for row in conn.execute(self._q_list)]
 
     @same_docstring_as(Store.replace)
     def replace(self, id_, obj):
@@ -257,11 +429,7 @@ class SqlStore(Store):
 
     def _save_or_replace(self, id_, obj):
         # build row to insert/update
-        fields = {'id': id_}
-
-        with closing(StringIO()) as dstdata:
-            make_pickler(self, dstdata, obj).dump(obj)
-            fields['data'] = dstdata.getvalue()
+        fields = {'id': id_, 'data': dumps(self, obj)}
 
         try:
             fields['state'] = obj.execution.state
@@ -270,52 +438,67 @@ class SqlStore(Store):
             fields['state'] = Run.State.UNKNOWN
 
         # insert into db
-        for column in self.extra_fields:
+        debug = gc3libs.log.isEnabledFor(logging.DEBUG)
+        for column, func in self._extra_fields_items:
             try:
-                fields[column] = self.extra_fields[column](obj)
-                gc3libs.log.debug(
-                    "Writing value '%s' in column '%s' for object '%s'",
-                    fields[column], column, obj)
+                fields[column] = func(obj)
+                if debug:
+                    gc3libs.log.debug(
+                        "Writing value '%s' in column '%s' for object '%s'",
+                        fields[column], column, obj)
             except Exception as ex:
                 gc3libs.log.warning(
                     "Error saving DB column '%s' of object '%s': %s: %s",
                     column, obj, ex.__class__.__name__, str(ex))
 
-        with closing(self._engine.connect()) as conn:
-            q = sql.select([self._tables.c.id]).where(self._tables.c.id == id_)
-            r = conn.execute(q)
-            if not r.fetchone():
-                # It's an insert
-                q = self._tables.insert().values(**fields)
-                conn.execute(q)
-            else:
+        columns = tuple(sorted(col for col in fields if col != 'id'))
+        with self._engine.begin() as conn:
+            if self._real_upsert_insert is not None:
+                # insert or update in a single statement
+                conn.execute(self._save_stmt('upsert', columns), fields)
+            elif (id_ in self._known_ids
+                  or conn.execute(self._q_exists, {'id_': id_}).fetchone()):
                 # it's an update
-                q = self._tables.update().where(
-                    self._tables.c.id == id_).values(**fields)
-                conn.execute(q)
+                fields['id_'] = id_
+                r = conn.execute(self._save_stmt('update', columns), fields)
+                if r.rowcount == 0:
+                    # row was removed meanwhile, e.g., by another process
+                    conn.execute(self._save_stmt('insert', columns), fields)
+            else:
+                # It's an insert
+                conn.execute(self._save_stmt('insert', columns), fields)
             obj.persistent_id = id_
             if hasattr(obj, 'changed'):
                 obj.changed = False
 
+        self._remember_id(id_)
         # return id
         return obj.persistent_id
 
+    def _remember_id(self, id_):
+        self._known_ids.pop(id_, None)
+        self._known_ids[id_] = True
+        if len(self._known_ids) > KNOWN_IDS_MAX:
+            # forget the least recently used one
+            self._known_ids.popitem(last=False)
+
     @same_docstring_as(Store.load)
     def load(self, id_):
-        with closing(self._engine.connect()) as conn:
-            q = sql.select([self._tables.c.data]).where(self._tables.c.id == id_)
-            rawdata = conn.execute(q).fetchone()
-            if not rawdata:
+        with self._engine.begin() as conn:
+            rawdata = conn.execute(self._q_load, {'id_': id_}).fetchone()
+            if not rawdata or rawdata[0] is None:
                 raise gc3libs.exceptions.LoadError(
                     "Unable to find any object with ID '%s'" % id_)
             obj = make_unpickler(self, StringIO(rawdata[0])).load()
+        self._remember_id(id_)
         super(SqlStore, self)._update_to_latest_schema()
         return obj
 
     @same_docstring_as(Store.remove)
     def remove(self, id_):
-        with closing(self._engine.connect()) as conn:
-            conn.execute(self._tables.delete().where(self._tables.c.id == id_))
+        with self._engine.begin() as conn:
+            conn.execute(self._q_delete, {'id_': id_})
+        self._known_ids.pop(id_, None)
 
 
 # register all URLs that SQLAlchemy can handle
@@ -345,7 +528,10 @@ def make_sqlstore(url, *args, **extra_args):
             os.makedirs(dir)
         # rewrite ``sqlite`` URLs to be RFC compliant, see:
         # https://github.com/uzh/gc3pie/issues/261
+        query = url.query
         url = "%s://%s/%s" % (url.scheme, url.netloc, url.path)
+        if query:
+            url += '?' + query
     return SqlStore(str(url), *args, **extra_args)
 
 
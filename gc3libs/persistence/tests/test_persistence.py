@@ -44,7 +44,7 @@ from gc3libs.persistence.accessors import GET
 from gc3libs.persistence.serialization import DEFAULT_PROTOCOL
 from gc3libs.persistence.idfactory import IdFactory
 from gc3libs.persistence.filesystem import FilesystemStore
-from gc3libs.persistence.sql import SqlStore
+from gc3libs.persistence.sql import SqlStore, sql_next_id_factory
 from gc3libs.url import Url
 
 
@@ -489,6 +489,86 @@ class SqlStoreChecks(GenericStoreChecks):
         assert len(rows) == 1
         assert rows[0][0] == obj.foo.value
 
+    def test_save_without_upsert(self):
+        """
+        Test the probe-then-update path used when the DB has no upsert.
+        """
+        # make sure the store is initialized, then disable upserts
+        self.store._engine
+        self.store._real_upsert_insert = None
+
+        # 1) a new object is inserted
+        obj = SimplePersistableObject('Original')
+        id_ = self.store.save(obj)
+        assert self.store.load(id_).value == 'Original'
+
+        # 2) a known object is updated in place
+        obj.value = 'Updated'
+        assert self.store.save(obj) == id_
+        assert self.store.load(id_).value == 'Updated'
+        assert self.store.list() == [id_]
+
+        # 3) a row removed behind our back is inserted again
+        other = self._make_store()
+        other.remove(id_)
+        assert id_ in self.store._known_ids
+        obj.value = 'Again'
+        assert self.store.save(obj) == id_
+        assert self.store.load(id_).value == 'Again'
+        assert self.store.list() == [id_]
+
+    def _count_reserved_rows(self):
+        q = sql.select([sqlfunc.count(self.store._tables.c.id)]).where(
+            self.store._tables.c.data.is_(None))
+        conn = self.store._engine.connect()
+        try:
+            return conn.execute(q).scalar()
+        finally:
+            conn.close()
+
+    def test_sql_next_id_qty(self):
+        next_id = sql_next_id_factory(self.store._engine,
+                                      self.store.table_name)
+        id1 = next_id()
+        ids = next_id(3)
+        assert isinstance(ids, list)
+        assert len(ids) == 3
+        assert len(set(ids)) == 3
+        assert min(ids) > id1
+
+    def test_sql_next_id_reserved_rows_are_not_listed(self):
+        self.store.save(SimplePersistableObject('GC3'))
+        next_id = sql_next_id_factory(self.store._engine,
+                                      self.store.table_name)
+        next_id()
+        assert self._count_reserved_rows() == 1
+        assert len(self.store.list()) == 1
+
+    def test_sql_next_id_save_into_reserved_row(self):
+        next_id = sql_next_id_factory(self.store._engine,
+                                      self.store.table_name)
+        obj = SimplePersistableObject('GC3')
+        obj.persistent_id = next_id()
+        id_ = self.store.save(obj)
+        assert id_ == obj.persistent_id
+        assert self._count_reserved_rows() == 0
+        assert self.store.load(id_).value == 'GC3'
+        assert self.store.list() == [id_]
+
+    def test_sql_next_id_releases_stale_reservations(self):
+        next_id = sql_next_id_factory(self.store._engine,
+                                      self.store.table_name)
+        obj = SimplePersistableObject('GC3')
+        obj.persistent_id = next_id()
+        next_id(3)
+        last = next_id()
+        # only the last reservation survives ...
+        assert self._count_reserved_rows() == 1
+        # ... but ids whose row was released can still be saved
+        id_ = self.store.save(obj)
+        assert self.store.load(id_).value == 'GC3'
+        assert next_id() > last
+
     @pytest.mark.skip(reason="FIXME: Check if test is still valid")
     def test_sql_error_if_no_extra_fields(self):
         """
@@ -578,6 +658,33 @@ class TestSqliteStore(SqlStoreChecks):
     def _make_store(self, **kwargs):
         return make_store(self.db_url, **kwargs)
 
+    def _pragma(self, store, name):
+        conn = store._engine.connect()
+        try:
+            return conn.execute('PRAGMA %s' % name).scalar()
+        finally:
+            conn.close()
+
+    def test_wal_is_off_by_default(self):
+        assert self._pragma(self.store, 'journal_mode').lower() != 'wal'
+        # 2 = FULL, SQLite's default
+        assert self._pragma(self.store, 'synchronous') == 2
+
+    def test_wal_opt_in(self):
+        store = make_store(Url('sqlite://%s?wal=yes' % self.tmpfile))
+        try:
+            assert self._pragma(store, 'journal_mode').lower() == 'wal'
+            # 1 = NORMAL
+            assert self._pragma(store, 'synchronous') == 1
+            # the query parameter must not leak into the SQLite file name
+            assert os.path.exists(self.tmpfile)
+            assert not os.path.exists(self.tmpfile + '?wal=yes')
+        finally:
+            store._engine.dispose()
+            for suffix in ('-wal', '-shm'):
+                if os.path.exists(self.tmpfile + suffix):
+                    os.remove(self.tmpfile + suffix)
+
 
 class TestSqliteStoreWithAlternateTable(TestSqliteStore):
 
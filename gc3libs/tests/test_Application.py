@@ -31,6 +31,15 @@ def test_invalid_invocation():
     with pytest.raises(TypeError):
         Application()
 
+# a valid set of `Application` ctor arguments; tests copy and alter it
+BASE_ARGS = {
+    'arguments': ['/bin/true'],
+    'inputs': [],
+    'outputs': [],
+    'output_dir': '/tmp',
+    'requested_cores': 1,
+}
+
 app_mandatory_arguments = (
     'arguments',
     'inputs',
@@ -41,12 +50,7 @@ app_mandatory_arguments = (
 @pytest.mark.parametrize("mandatory", app_mandatory_arguments)
 def test_mandatory_arguments(mandatory):
     # check for all mandatory arguments
-    args = {
-        'arguments': ['/bin/true'],
-        'inputs': [],
-        'outputs': [],
-        'output_dir': '/tmp',
-    }
+    args = dict(BASE_ARGS)
 
     # test *valid* invocation
     Application(**args)
@@ -78,13 +82,7 @@ def test_wrong_type_arguments(wrongarg):
     # What happens when you request non-integer cores/memory/walltime?
     # what happens when you request non-existent architecture?
 
-    args = {
-        'arguments': ['/bin/true'],
-        'inputs': [],
-        'outputs': [],
-        'output_dir': '/tmp',
-        'requested_cores': 1,
-    }
+    args = dict(BASE_ARGS)
 
     key, value = wrongarg
 